@@ -1,22 +1,32 @@
 # alphabet_rl.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, abort, request
 from flask_cors import CORS
-import json, os, string, random
-from collections import defaultdict
+import atexit, fcntl, json, os, shutil, string, threading
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
+import orjson
+from numba import njit
 
 app = Flask(__name__)
 CORS(app)
 
 LETTERS = list(string.ascii_uppercase)  # A..Z
-Q_PATH = os.environ.get("Q_PATH", "q_table.json")
-
-# Q-table: { "state_key": {"action": q_value, ...}, ... }
-Q = defaultdict(dict)
+LETTER_IDX = {c: i for i, c in enumerate(LETTERS)}
+Q_PATH = os.environ.get("Q_PATH", "q_table.json")  # JSON table, imported once into Q_BIN_PATH
+# Live binary table. Point it at tmpfs (e.g. Q_BIN_PATH=/dev/shm/alphabet-rl.bin, unique
+# per instance) so updates never wait on the disk; Q_BACKUP_PATH is the persistent copy,
+# refreshed every SNAPSHOT_EVERY seconds
+Q_BIN_PATH = os.environ.get("Q_BIN_PATH", "q_table.bin")
+Q_BACKUP_PATH = os.environ.get("Q_BACKUP_PATH", "q_table.bin.bak")
+N_PATH = Q_BIN_PATH + ".counts"  # visit counts for UCB, stored and snapshotted alongside Q
+N_BACKUP_PATH = Q_BACKUP_PATH + ".counts"
+SNAPSHOT_EVERY = 30.0
 
 ALPHA = 0.5   # learning rate
 GAMMA = 0.9   # discount
-EPSILON = 0.15  # exploration
+UCB_C = 1.0  # exploration bonus weight
 MIN_RECENT_FOR_REVIEW = 2
 PREFER_MOVE_ON_AT_ML = 1   # when mastery_level >= 1, prefer moving next
 
@@ -26,71 +36,240 @@ ACTIONS = [
     "jump_trouble",
     "review_recent"
 ]
+ACTION_IDX = {a: i for i, a in enumerate(ACTIONS)}
+N_ML = 3  # mastery levels 0=unseen, 1=practicing, 2=mastered
+
+# Q-table: Q_arr[state_key, action_idx] -> q_value, state_key = letter_idx * N_ML + mastery_level
+# Backed by a float32 memmap of Q_BIN_PATH, so the OS page cache persists it and
+# forked workers share one view. Reads are lock-free (aligned float32 loads);
+# writes go through q_write_lock(). N_arr[state_key, action_idx] counts updates.
+N_STATES = len(LETTERS) * N_ML
+Q_SHAPE = (N_STATES, len(ACTIONS))
+_q_mm = None
+Q_arr = None
+_n_mm = None
+N_arr = None
+_q_lock = threading.Lock()  # between threads/greenlets of one worker
+_flock_file = None           # flock on Q_BIN_PATH + ".lock", between worker processes
+_flock_pid = None
+
+_LOADED = False
+
+def _restore(path, backup_path):
+    if not os.path.exists(path) and os.path.exists(backup_path):
+        # tmpfs was wiped (reboot); resume from the last snapshot
+        tmp = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(backup_path, tmp)
+        os.replace(tmp, path)
+    return os.path.exists(path)
+
+def _write_table(path, arr):
+    # Build off to the side and rename, so a crash never leaves a full-size partial table
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        arr.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _map_table(path, dtype):
+    size = np.dtype(dtype).itemsize * N_STATES * len(ACTIONS)
+    if os.path.getsize(path) != size:
+        # memmap would happily map any larger file (e.g. the JSON table) as floats
+        raise ValueError(f"{path} is not a {N_STATES}x{len(ACTIONS)} {np.dtype(dtype)} table")
+    return np.memmap(path, dtype=dtype, mode="r+", shape=Q_SHAPE)
+
+def _import_json_q(path):
+    q_table = np.zeros(Q_SHAPE, dtype=np.float32)
+    if not os.path.exists(path):
+        return q_table
+    with open(path, "r") as f:
+        raw = json.load(f)
+    for skey, row in raw.items():
+        try:
+            si = parse_state_key(skey)
+        except (KeyError, TypeError, ValueError):
+            app.logger.warning("Skipping unknown state %r in %s", skey, path)
+            continue
+        for action, q in row.items():
+            try:
+                q_table[si, ACTION_IDX[action]] = q
+            except (KeyError, TypeError, ValueError):
+                app.logger.warning("Skipping %r=%r for %s in %s", action, q, skey, path)
+    return q_table
 
 def load_q():
-    global Q
-    if os.path.exists(Q_PATH):
-        with open(Q_PATH, "r") as f:
-            raw = json.load(f)
-            Q = defaultdict(dict, raw)
-def is_mastered(ltr, mastery_map):
-    return mastery_map.get(ltr, 0) >= 2
-
-
-def save_q():
-    with open(Q_PATH, "w") as f:
-        json.dump(Q, f)
-
-def state_key(letter: str, mastery_level: int) -> str:
-    return f"{letter}:{mastery_level}"
-
-
-def heuristic_policy(letter, ml, mastery_map, recent):
+    global _q_mm, Q_arr, _n_mm, N_arr, _LOADED
+    if _LOADED:
+        return
+    have_q = _restore(Q_BIN_PATH, Q_BACKUP_PATH)
+    have_n = _restore(N_PATH, N_BACKUP_PATH)
+    if not have_q:
+        _write_table(Q_BIN_PATH, _import_json_q(Q_PATH))
+    _q_mm = _map_table(Q_BIN_PATH, np.float32)
+    if not (have_q and have_n):
+        # New table, or one from before visit counts existed: treat every learned entry as tried once
+        _write_table(N_PATH, (np.asarray(_q_mm) != 0).astype(np.int32))
+    _n_mm = _map_table(N_PATH, np.int32)
+    # plain ndarray views of the mappings, for numba
+    Q_arr = np.asarray(_q_mm)
+    N_arr = np.asarray(_n_mm)
+    # Compile (or load from cache) the numba kernels here, in gunicorn's master, so forked
+    # workers don't stall their greenlets on it; _update runs on scratch copies
+    _ucb(Q_arr, N_arr, 0, UCB_C)
+    _update(np.zeros_like(Q_arr), np.zeros_like(N_arr), 0, 0, 0.0, 0)
+    _LOADED = True
+
+def snapshot_q():
+    tables = ((_q_mm, Q_BIN_PATH, Q_BACKUP_PATH), (_n_mm, N_PATH, N_BACKUP_PATH))
+    # Copy Q and counts under the write lock so both backups come from the same update
+    with q_write_lock():
+        for mm, path, backup_path in tables:
+            mm.flush()
+            shutil.copyfile(path, f"{backup_path}.{os.getpid()}.tmp")
+    for _, _, backup_path in tables:
+        tmp = f"{backup_path}.{os.getpid()}.tmp"
+        with open(tmp, "rb+") as f:
+            getattr(os, "fdatasync", os.fsync)(f.fileno())
+        os.replace(tmp, backup_path)
+
+def _snapshot_loop():
+    while not _stop_snapshots.wait(SNAPSHOT_EVERY):
+        try:
+            snapshot_q()
+        except Exception:
+            # keep the thread alive: a full disk now shouldn't stop every later snapshot
+            app.logger.exception("Q snapshot to %s failed", Q_BACKUP_PATH)
+
+_stop_snapshots = threading.Event()
+
+_snapshot_pid = None
+
+def _flush_on_exit():
+    # Forked gunicorn workers inherit this hook; only the process that ran init() snapshots
+    if os.getpid() != _snapshot_pid:
+        return
+    _stop_snapshots.set()
+    snapshot_q()
+
+def _reset_q_lock():
+    # The snapshot thread may hold _q_lock in the master at fork; don't hand children a held lock
+    global _q_lock
+    _q_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_q_lock)
+
+@contextmanager
+def q_write_lock():
+    global _flock_file, _flock_pid
+    with _q_lock:
+        if _flock_pid != os.getpid():
+            # flock belongs to the open file, so a descriptor inherited across fork
+            # would be shared with the master; each worker opens its own
+            _flock_file = open(Q_BIN_PATH + ".lock", "a")
+            _flock_pid = os.getpid()
+        fcntl.flock(_flock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_flock_file, fcntl.LOCK_UN)
+
+def ojson(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+# What malformed client fields raise while being read; handlers answer these with 400
+INPUT_ERRORS = (AttributeError, KeyError, TypeError, ValueError)
+
+def json_body():
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400)  # malformed body, as get_json(force=True) reported it
+
+def state_key(letter: str, mastery_level: int) -> int:
+    # Row of Q_arr; out-of-range levels are clamped
+    return LETTER_IDX[letter] * N_ML + min(max(int(mastery_level), 0), N_ML - 1)
+
+def state_label(s: int) -> str:
+    # Wire format of a state key, e.g. "C:0"
+    return f"{LETTERS[s // N_ML]}:{s % N_ML}"
+
+@lru_cache(maxsize=N_STATES * 2)
+def parse_state_key(skey: str) -> int:
+    letter, ml = skey.split(":")
+    return state_key(letter, int(ml))
+
+
+def distinct_unmastered_recent(recent, mastery_map, k=3):
+    # last up to k distinct *unmastered* recent letters (most-recent first)
+    seen = set()
+    out = []
+    for l in reversed(recent):
+        if l in seen or mastery_map.get(l, 0) >= 2:
+            continue
+        seen.add(l)
+        out.append(l)
+        if len(out) == k:
+            break
+    return out
+
+
+def heuristic_policy(letter, ml, mastery_map, review):
     # If mastered, definitely move on
     if ml >= 2:
         return "move_next"
     # Prefer moving on once practicing starts
     if ml >= PREFER_MOVE_ON_AT_ML:
         return "move_next"
+    # The rest is pure in its inputs, so memoize on a hashable form of them
+    return _heuristic_cached(letter, tuple(sorted(mastery_map.items())), tuple(review))
+
+
+@lru_cache(maxsize=4096)
+def _heuristic_cached(letter, mastery_items, review):
+    mastery_map = dict(mastery_items)
     # If there are true trouble letters, jump to one
     t = pick_trouble_letter(mastery_map, letter) if mastery_map else None
     if t and t != letter:
         return "jump_trouble"
     # If there’s enough recent material (non-mastered), review it
-    if recent:
-        recent_unmastered = [r for r in set(recent) if not is_mastered(r, mastery_map)]
-        if len(recent_unmastered) >= MIN_RECENT_FOR_REVIEW:
-            return "review_recent"
+    if len(review) >= MIN_RECENT_FOR_REVIEW:
+        return "review_recent"
     # Otherwise, practice current
     return "practice_current"
 
 
-def argmax_action(skey: str):
-    # If we have nothing learned for this state yet, defer to heuristic instead of random
-    if skey not in Q or not Q[skey]:
-        return None  # signal "no learned action"
-    return max(Q[skey].items(), key=lambda kv: kv[1])[0]
+@njit(cache=True)
+def _ucb(Q_arr, N_arr, s, c):
+    n = N_arr[s]
+    total = n.sum()
+    if total == 0:
+        return -1  # never updated: nothing learned yet
+    return (Q_arr[s] + c * np.sqrt(np.log(total + 1) / (n + 1))).argmax()
+
+
+@njit(cache=True, fastmath=True)
+def _update(Q_arr, N_arr, s, ai, r, ns):
+    m = Q_arr[ns].max()
+    Q_arr[s, ai] += ALPHA * (r + GAMMA * m - Q_arr[s, ai])
+    N_arr[s, ai] += 1
 
-def epsilon_greedy(skey: str, letter, ml, mastery_map, recent):
-    learned_best = argmax_action(skey)
-    if learned_best is None:
-        # Cold-start: use heuristic, not random
-        base = heuristic_policy(letter, ml, mastery_map, recent)
-        # Still allow a *bit* of exploration if you want:
-        return random.choice(ACTIONS) if random.random() < EPSILON else base
-    # We have learned values; do normal epsilon-greedy
-    return random.choice(ACTIONS) if random.random() < EPSILON else learned_best
 
+def ucb_pick(s: int, letter, ml, mastery_map, review):
+    # UCB1: learned value plus a bonus for rarely tried actions; deterministic, no RNG
+    ai = _ucb(Q_arr, N_arr, s, UCB_C)
+    if ai >= 0:
+        return ACTIONS[ai]
+    # Cold-start: use heuristic, not random
+    return heuristic_policy(letter, ml, mastery_map, review)
 
-def update_q(skey: str, action: str, reward: float, next_skey: str):
-    old_q = Q[skey].get(action, 0.0)
-    next_max = max(Q[next_skey].values(), default=0.0)
-    new_q = old_q + ALPHA * (reward + GAMMA * next_max - old_q)
-    Q[skey][action] = new_q
-    save_q()
+
+def update_q(s: int, action: str, reward: float, next_s: int):
+    with q_write_lock():
+        _update(Q_arr, N_arr, s, ACTION_IDX[action], reward, next_s)
 
 def next_letter(letter: str, mastery_map=None):
-    idx = LETTERS.index(letter)
+    idx = LETTER_IDX[letter]
     # Try to find the next letter that is not mastered
     if mastery_map:
         n = len(LETTERS)
@@ -103,14 +282,61 @@ def next_letter(letter: str, mastery_map=None):
 
 
 def pick_trouble_letter(mastery_map, current_letter):
-    # prefer mastery 0, then 1
-    candidates = [l for l, m in mastery_map.items() if m == 0] or \
-                 [l for l, m in mastery_map.items() if m == 1]
-    if not candidates:
-        return None
-    # choose the nearest in alphabet distance to current
-    cidx = LETTERS.index(current_letter)
-    return min(candidates, key=lambda l: abs(LETTERS.index(l) - cidx))
+    # prefer mastery 0, then 1; among those the nearest in alphabet distance to current
+    cidx = LETTER_IDX[current_letter]
+    best, best_key = None, None
+    for l, m in mastery_map.items():
+        if m != 0 and m != 1:
+            continue
+        k = (m, abs(LETTER_IDX[l] - cidx))
+        if best is None or k < best_key:
+            best, best_key = l, k
+    return best
+
+
+# Action -> concrete recommendation payload; each returns (action, target)
+def _practice_current(letter, mastery_map, review):
+    return "practice_current", {"letter": letter, "list": []}
+
+def _move_next(letter, mastery_map, review):
+    return "move_next", {"letter": next_letter(letter, mastery_map), "list": []}
+
+def _jump_trouble(letter, mastery_map, review):
+    t = pick_trouble_letter(mastery_map, letter) if mastery_map else None
+    return "jump_trouble", {"letter": t or letter, "list": []}
+
+def _review_recent(letter, mastery_map, review):
+    if not review:
+        # nothing to review—move on
+        return _move_next(letter, mastery_map, review)
+    # most recent unique, unmastered first
+    return "review_recent", {"letter": review[0], "list": review}
+
+ACTION_HANDLERS = {
+    "practice_current": _practice_current,
+    "move_next": _move_next,
+    "jump_trouble": _jump_trouble,
+    "review_recent": _review_recent,
+}
+
+
+# Load once at import; request handlers only touch the in-memory table.
+# Under gunicorn's preload_app this runs in the master and workers inherit the mappings.
+load_q()
+
+
+_STARTED = False
+
+def init():
+    # Start snapshotting to Q_BACKUP_PATH; importing the module doesn't.
+    # gunicorn's when_ready hook calls this in the master, so one snapshotter serves all workers.
+    global _STARTED, _snapshot_pid
+    if _STARTED:
+        return
+    _snapshot_pid = os.getpid()
+    atexit.register(_flush_on_exit)
+    threading.Thread(target=_snapshot_loop, name="q-snapshot", daemon=True).start()
+    _STARTED = True
 
 
 @app.route("/alphabet/next", methods=["POST"])
@@ -124,57 +350,26 @@ def api_next():
       "recent_history": ["A","B","B"]  # optional, for review_recent
     }
     """
-    load_q()
-    data = request.get_json(force=True)
-    letter = data["current_letter"]
-    ml = int(data.get("mastery_level", 0))
-    mastery_map = data.get("mastery_map", {})
-    recent = data.get("recent_history", [])
-    # 🚫 Skip mastered letters
-    if mastery_map.get(letter, 0) >= 2:
-        letter = next_letter(letter, mastery_map)
-        ml = mastery_map.get(letter, 0)
-
-    skey = state_key(letter, ml)
-    action = epsilon_greedy(skey, letter, ml, mastery_map, recent)
-
-
-    # Compute a concrete recommendation payload
-    target = {"letter": letter, "list": []}
-
-    if action == "practice_current":
-        target["letter"] = letter
-
-    elif action == "move_next":
-        target["letter"] = next_letter(letter, mastery_map)
-
-    elif action == "jump_trouble":
-        t = pick_trouble_letter(mastery_map, letter) if mastery_map else None
-        target["letter"] = t or letter
-
-
-    elif action == "review_recent":
-        # last up to 3 distinct *unmastered* recent letters (most-recent first)
-        seen = []
-        for l in reversed(recent):
-            if l not in seen and not is_mastered(l, mastery_map):
-                seen.append(l)
-            if len(seen) == 3:
-                break
-        if not seen:
-            # nothing to review—move on
-            action = "move_next"
-            target["letter"] = next_letter(letter, mastery_map)
-            target["list"] = []
-        else:
-            target["list"] = seen
-            target["letter"] = seen[0]  # most recent unique, unmastered
-
-    if is_mastered(target["letter"], mastery_map):
-        target["letter"] = next_letter(letter, mastery_map)
-    if target.get("list"):
-        target["list"] = [l for l in target["list"] if not is_mastered(l, mastery_map)]
-    return jsonify({"action": action, "target": target, "state_key": skey})
+    data = json_body()
+    try:
+        letter = data["current_letter"]
+        ml = int(data.get("mastery_level", 0))
+        mastery_map = data.get("mastery_map", {})
+        recent = data.get("recent_history", [])
+        # 🚫 Skip mastered letters
+        if mastery_map.get(letter, 0) >= 2:
+            letter = next_letter(letter, mastery_map)
+            ml = int(mastery_map.get(letter, 0))
+        s = state_key(letter, ml)
+    except INPUT_ERRORS:
+        abort(400)  # missing field, unknown letter or non-numeric level
+    review = distinct_unmastered_recent(recent, mastery_map)
+    action = ucb_pick(s, letter, ml, mastery_map, review)
+
+
+    # Compute a concrete recommendation payload; handlers only ever pick unmastered letters
+    action, target = ACTION_HANDLERS[action](letter, mastery_map, review)
+    return ojson({"action": action, "target": target, "state_key": state_label(s)})
 
 @app.route("/alphabet/feedback", methods=["POST"])
 def api_feedback():
@@ -187,23 +382,28 @@ def api_feedback():
       "next_state": { "letter":"C", "mastery_level": 1 }
     }
     """
-    load_q()
-    data = request.get_json(force=True)
-    skey = data["state_key"]
-    action = data["action"]
-    reward = float(data["reward"])
-    next_letter_ = data["next_state"]["letter"]
-    next_ml = int(data["next_state"]["mastery_level"])
-    next_skey = state_key(next_letter_, next_ml)
-
-    update_q(skey, action, reward, next_skey)
-    return jsonify({"ok": True})
+    data = json_body()
+    try:
+        s = parse_state_key(data["state_key"])
+        action = data["action"]
+        if action not in ACTION_IDX:
+            abort(400)
+        reward = float(data["reward"])
+        next_letter_ = data["next_state"]["letter"]
+        next_ml = int(data["next_state"]["mastery_level"])
+        next_s = state_key(next_letter_, next_ml)
+    except INPUT_ERRORS:
+        abort(400)  # missing field, malformed state_key, unknown letter or non-numeric value
+
+    update_q(s, action, reward, next_s)
+    return ojson({"ok": True})
 
 @app.get("/")
 def health():
-    return {"ok": True, "service": "alphabet-rl"}
+    return ojson({"ok": True, "service": "alphabet-rl"})
 
 
 if __name__ == "__main__":
-    load_q()
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    # Local runs only; serve with `gunicorn -c gunicorn_conf.py alphabet_rl:app`
+    init()
+    app.run(host="0.0.0.0", port=8000)
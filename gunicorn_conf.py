@@ -0,0 +1,14 @@
+# gunicorn_conf.py
+# gunicorn -c gunicorn_conf.py alphabet_rl:app
+
+import multiprocessing, os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+worker_class = "gevent"
+preload_app = True  # map Q once in the master; workers inherit the shared mapping
+
+
+def when_ready(server):
+    import alphabet_rl
+    alphabet_rl.init()